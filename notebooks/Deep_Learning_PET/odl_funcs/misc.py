@@ -12,21 +12,93 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file, You can
 # obtain one at https://mozilla.org/MPL/2.0/.
 
-import numpy as np
-
-
-def _getshapes_2d(center, max_radius, shape):
-    """Calculate indices and slices for the bounding box of a disk."""
-    index_mean = shape * center
-    index_radius = max_radius / 2.0 * np.array(shape)
+import math
 
+import numpy as np
+from numba import njit, prange
+
+
+# Pixel coordinates on [-1, 1], keyed on the image shape
+_GRID_CACHE = {}
+
+def _get_grid(shape):
+    """Return the (cached) pixel coordinates of ``shape`` in [-1, 1]."""
+    shape = tuple(shape)
+    if shape not in _GRID_CACHE:
+        # move points to [-1, 1]
+        grid = tuple((np.linspace(0, 1, n) - 0.5) / 0.5 for n in shape)
+        for g in grid:
+            g.flags.writeable = False
+        _GRID_CACHE[shape] = grid
+    return _GRID_CACHE[shape]
+
+@njit
+def _getshapes_2d(center_x, center_y, radius_x, radius_y, h, w):
+    """Calculate the index bounds ``(imin, imax, jmin, jmax)`` of a disk."""
     # Avoid negative indices
-    min_idx = np.maximum(np.floor(index_mean - index_radius), 0).astype(int)
-    max_idx = np.ceil(index_mean + index_radius).astype(int)
-    idx = [slice(minx, maxx) for minx, maxx in zip(min_idx, max_idx)]
-    shapes = [(idx[0], slice(None)),
-              (slice(None), idx[1])]
-    return tuple(idx), tuple(shapes)
+    imin = max(math.floor(h * center_x - radius_x / 2.0 * h), 0)
+    imax = min(math.ceil(h * center_x + radius_x / 2.0 * h), h)
+    jmin = max(math.floor(w * center_y - radius_y / 2.0 * w), 0)
+    jmax = min(math.ceil(w * center_y + radius_y / 2.0 * w), w)
+    return imin, imax, jmin, jmax
+
+@njit(fastmath=True, cache=True)
+def _draw_ellipse(p, ellipse, grid_x, grid_y):
+    """Add a single ellipse (a row of 6 parameters) to the 2D image ``p``."""
+    h = grid_x.shape[0]
+    w = grid_y.shape[0]
+
+    intensity = ellipse[0]
+    a_squared = ellipse[1] ** 2
+    b_squared = ellipse[2] ** 2
+    x0 = ellipse[3]
+    y0 = ellipse[4]
+    theta = ellipse[5]
+
+    # A zero axis gives a degenerate ellipse that covers no pixels
+    if a_squared == 0 or b_squared == 0:
+        return
+
+    ctheta = math.cos(theta)
+    stheta = math.sin(theta)
+    inv_a_squared = 1.0 / a_squared
+    inv_b_squared = 1.0 / b_squared
+
+    # Calculate the points that could possibly be inside the volume.
+    # Since the points are rotated, we cannot do anything directional
+    # without more logic
+    radius_x = math.sqrt(abs(ctheta) * a_squared + abs(stheta) * b_squared)
+    radius_y = math.sqrt(abs(stheta) * a_squared + abs(ctheta) * b_squared)
+    center_x = (x0 + 1.0) / 2.0
+    center_y = (y0 + 1.0) / 2.0
+    imin, imax, jmin, jmax = _getshapes_2d(center_x, center_y,
+                                           radius_x, radius_y, h, w)
+
+    for i in range(imin, imax):
+        dx = grid_x[i] - x0
+        for j in range(jmin, jmax):
+            dy = grid_y[j] - y0
+            # Rotate the points to the expected coordinate system.
+            xr = ctheta * dx + stheta * dy
+            yr = -stheta * dx + ctheta * dy
+            r = inv_a_squared * xr * xr + inv_b_squared * yr * yr
+            # Add the ellipse intensity to the points within the ellipse
+            if r <= 1:
+                p[i, j] += intensity
+
+@njit(cache=True)
+def _draw_ellipses(p, ellipses, grid_x, grid_y):
+    """Add every ellipse in ``ellipses`` (an ``(N, 6)`` array) to ``p``."""
+    for k in range(ellipses.shape[0]):
+        _draw_ellipse(p, ellipses[k], grid_x, grid_y)
+
+@njit(parallel=True, cache=True)
+def _draw_ellipses_batch(p, ellipses, counts, grid_x, grid_y):
+    """Add the first ``counts[b]`` ellipses of ``ellipses[b]`` to ``p[b]``."""
+    # The phantoms are independent, so parallelise over the batch
+    for b in prange(p.shape[0]):
+        for k in range(counts[b]):
+            _draw_ellipse(p[b], ellipses[b, k], grid_x, grid_y)
 
 def ellipse_phantom(shape, ellipses):
     
@@ -36,8 +108,9 @@ def ellipse_phantom(shape, ellipses):
     ----------
     shape : `tuple`
         Size of image
-    ellipses : list of lists
-        Each row should contain the entries ::
+    ellipses : list of lists or numpy.ndarray
+        Either a list of ellipses or an ``(N, 6)`` float array with one
+        ellipse per row. Each row should contain the entries ::
 
             'value',
             'axis_1', 'axis_2',
@@ -60,96 +133,75 @@ def ellipse_phantom(shape, ellipses):
     # Blank image
     p = np.zeros(shape)
 
-    grid_in = (np.expand_dims(np.linspace(0, 1, shape[0]),1),
-                    np.expand_dims(np.linspace(0, 1, shape[1]),0))
-
-    # move points to [-1, 1]
-    grid = []
-    for i in range(2):
-        mean_i = 0.5
-        # Where space.shape = 1, we have minp = maxp, so we set diff_i = 1
-        # to avoid division by zero. Effectively, this allows constructing
-        # a slice of a 2D phantom.
-        diff_i = 0.5
-        grid.append((grid_in[i] - mean_i) / diff_i)
-
-    for ellip in ellipses:
-        assert len(ellip) == 6
-
-        intensity = ellip[0]
-        a_squared = ellip[1] ** 2
-        b_squared = ellip[2] ** 2
-        x0 = ellip[3]
-        y0 = ellip[4]
-        theta = ellip[5]
-
-        scales = [1 / a_squared, 1 / b_squared]
-        center = (np.array([x0, y0]) + 1.0) / 2.0
-
-        # Create the offset x,y and z values for the grid
-        if theta != 0:
-            # Rotate the points to the expected coordinate system.
-            ctheta = np.cos(theta)
-            stheta = np.sin(theta)
-
-            mat = np.array([[ctheta, stheta],
-                            [-stheta, ctheta]])
-
-            # Calculate the points that could possibly be inside the volume
-            # Since the points are rotated, we cannot do anything directional
-            # without more logic
-            max_radius = np.sqrt(
-                np.abs(mat).dot([a_squared, b_squared]))
-            idx, shapes = _getshapes_2d(center, max_radius, shape)
-
-            subgrid = [g[idi] for g, idi in zip(grid, shapes)]
-            offset_points = [vec * (xi - x0i)[..., None]
-                             for xi, vec, x0i in zip(subgrid,
-                                                     mat.T,
-                                                     [x0, y0])]
-            rotated = offset_points[0] + offset_points[1]
-            np.square(rotated, out=rotated)
-            radius = np.dot(rotated, scales)
-        else:
-            # Calculate the points that could possibly be inside the volume
-            max_radius = np.sqrt([a_squared, b_squared])
-            idx, shapes = _getshapes_2d(center, max_radius, shape)
-
-            subgrid = [g[idi] for g, idi in zip(grid, shapes)]
-            squared_dist = [ai * (xi - x0i) ** 2
-                            for xi, ai, x0i in zip(subgrid,
-                                                   scales,
-                                                   [x0, y0])]
-
-            # Parentheses to get best order for broadcasting
-            radius = squared_dist[0] + squared_dist[1]
-
-        # Find the points within the ellipse
-        inside = radius <= 1
-
-        # Add the ellipse intensity to those points
-        p[idx][inside] += intensity
+    ellipses = np.ascontiguousarray(ellipses, dtype=np.float64)
+    if ellipses.size == 0:
+        return p
+    assert ellipses.ndim == 2 and ellipses.shape[1] == 6
+
+    grid_x, grid_y = _get_grid(shape)
+    _draw_ellipses(p, ellipses, grid_x, grid_y)
+    return p
+
+def ellipse_phantom_batch(shape, list_of_ellipses):
+    """Create a batch of 2d ellipse phantoms in one go.
+
+    Parameters
+    ----------
+    shape : `tuple`
+        Size of each image
+    list_of_ellipses : list of (list of lists or numpy.ndarray)
+        One set of ellipses per phantom, each in the format taken by
+        `ellipse_phantom`. The phantoms may have different numbers of
+        ellipses.
+
+    Returns
+    -------
+    phantoms : numpy.ndarray
+        Array of shape ``(len(list_of_ellipses),) + shape``.
+    """
+    list_of_ellipses = [np.asarray(ellips, dtype=np.float64)
+                        for ellips in list_of_ellipses]
+    for ellips in list_of_ellipses:
+        assert ellips.size == 0 or (ellips.ndim == 2 and ellips.shape[1] == 6)
+
+    n_batch = len(list_of_ellipses)
+    counts = np.array([len(e) for e in list_of_ellipses], dtype=np.int64)
+
+    # Pad to a dense (B, N, 6) array, unused rows are skipped via counts
+    ellipses = np.zeros((n_batch, counts.max(initial=0), 6))
+    for b, ellips in enumerate(list_of_ellipses):
+        if counts[b]:
+            ellipses[b, :counts[b]] = ellips
+
+    p = np.zeros((n_batch,) + tuple(shape))
+    grid_x, grid_y = _get_grid(shape)
+    _draw_ellipses_batch(p, ellipses, counts, grid_x, grid_y)
     return p
 
-def random_shapes():
-    x_0 = 1 * np.random.rand() - 0.5
-    y_0 = 1 * np.random.rand() - 0.5
-    return [np.random.exponential(0.4),
-            1 * np.random.rand() - 0.5, 1 * np.random.rand() - 0.5,
-            x_0, y_0,
-            np.random.rand() * 2 * np.pi]
+def random_shapes(n):
+    # Draw the parameters of all ``n`` ellipses at once, one row per ellipse.
+    # Uses the global numpy RNG so that seeding via np.random.seed still works
+    return np.column_stack([np.random.exponential(0.4, n),
+                            1 * np.random.rand(n) - 0.5,
+                            1 * np.random.rand(n) - 0.5,
+                            1 * np.random.rand(n) - 0.5,
+                            1 * np.random.rand(n) - 0.5,
+                            np.random.rand(n) * 2 * np.pi])
 
 def random_phantom(space, n_ellipse=20):
     n = np.random.poisson(n_ellipse)
-    shapes = [random_shapes() for _ in range(n)]
-    for i in range(n):
-        shapes[i][0] = np.random.exponential(0.4)
-    x = ellipse_phantom(space[1:], shapes)
+    x = ellipse_phantom(space[1:], random_shapes(n))
     x = [x]
     return np.array(x)
 
+# Shepp-Logan phantoms already computed, keyed on the image shape
+_SL_CACHE = {}
+
 def shepp_logan(space):
-    rad18 = np.deg2rad(18.0)
+    key = tuple(space[1:])
+    if key in _SL_CACHE:
+        return _SL_CACHE[key].copy()
+    rad18 = math.radians(18.0)
     #            value  axisx  axisy     x       y  rotation
     ellipsoids= [[0.55, 0.69, 0.92, 0.0, 0.0, 0],
                 [0.60, 0.6624, 0.874, 0.0, -0.0184, 0],
@@ -163,4 +215,5 @@ def shepp_logan(space):
                 [1.28, 0.023, 0.046, 0.06, -0.605, 0]]
     x = ellipse_phantom(space[1:], ellipsoids)
     x = [x]
-    return np.array(x)
\ No newline at end of file
+    _SL_CACHE[key] = np.array(x)
+    return _SL_CACHE[key].copy()